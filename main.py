@@ -1,55 +1,150 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, BackgroundTasks
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel, Field
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Tuple
 import os
-from moviepy.editor import ImageClip, AudioFileClip, VideoFileClip, concatenate_videoclips
-import uuid
+import asyncio
 import shutil
 import subprocess
 import tempfile
-import oss2
+import json
+import hashlib
 import time
 import datetime
 import requests
-from PIL import Image
-import io
+from requests.adapters import HTTPAdapter
+import mimetypes
+from urllib.parse import urlparse
 
 app = FastAPI(title="视频处理API")
 
-# 创建输出目录
-OUTPUT_DIR = "output"
-os.makedirs(OUTPUT_DIR, exist_ok=True)
-
 # 创建静态文件目录
 STATIC_DIR = "static"
 os.makedirs(os.path.join(STATIC_DIR, "videos"), exist_ok=True)
 
+# 全局HTTP会话，复用TCP/TLS连接，避免每次下载都重新握手
+HTTP_SESSION = requests.Session()
+HTTP_ADAPTER = HTTPAdapter(pool_connections=32, pool_maxsize=64)
+HTTP_SESSION.mount("http://", HTTP_ADAPTER)
+HTTP_SESSION.mount("https://", HTTP_ADAPTER)
+
+# 远程文件缓存目录，文件名为URL的哈希值
+CACHE_DIR = os.path.join(STATIC_DIR, "cache")
+# 任务使用的缓存文件硬链接，与缓存位于同一文件系统
+CACHE_JOB_DIR = os.path.join(CACHE_DIR, "jobs")
+os.makedirs(CACHE_JOB_DIR, exist_ok=True)
+# 清理进程崩溃时遗留的任务硬链接；任务状态只保存在本进程内存中，启动时不存在进行中的任务
+for leftover_name in os.listdir(CACHE_JOB_DIR):
+    os.remove(os.path.join(CACHE_JOB_DIR, leftover_name))
+
+# 同时进行的编码任务数量，每个编码任务平分CPU核心，避免线程过多互相争抢
+MAX_CONCURRENT_ENCODES = 2
+THREADS_PER_ENCODE = max(1, (os.cpu_count() or 1) // MAX_CONCURRENT_ENCODES)
+encode_semaphore = asyncio.Semaphore(MAX_CONCURRENT_ENCODES)
+
+# 各编码器的预设和质量参数，still用于静态图片生成的视频
+VIDEO_ENCODER_OPTIONS = {
+    'libx264': {
+        'default': ('veryfast', ['-crf', '23']),
+        'still': ('ultrafast', ['-crf', '28', '-tune', 'stillimage']),
+    },
+    'h264_nvenc': {
+        # -b:v 0 取消默认码率上限，让 -cq 真正按质量控制
+        'default': ('p4', ['-tune', 'hq', '-rc', 'vbr', '-cq', '23', '-b:v', '0']),
+        'still': ('p4', ['-tune', 'hq', '-rc', 'vbr', '-cq', '28', '-b:v', '0']),
+    },
+    'h264_qsv': {
+        'default': ('veryfast', ['-global_quality', '23']),
+        'still': ('veryfast', ['-global_quality', '28']),
+    },
+}
+
+def video_encoder_options(still_image: bool = False, encoder: Optional[str] = None) -> Tuple[str, List[str]]:
+    """返回视频编码器（默认为当前使用的编码器）的预设和额外参数"""
+    return VIDEO_ENCODER_OPTIONS[encoder or VIDEO_ENCODER]['still' if still_image else 'default']
+
+def video_codec_args(still_image: bool = False, encoder: Optional[str] = None) -> List[str]:
+    """返回ffmpeg命令中的视频编码参数"""
+    encoder = encoder or VIDEO_ENCODER
+    preset, params = video_encoder_options(still_image, encoder)
+    return ['-c:v', encoder, '-preset', preset] + params
+
+def detect_video_encoder() -> str:
+    """检测可用的H.264硬件编码器（NVENC/QSV），不可用时使用libx264"""
+    try:
+        result = subprocess.run(['ffmpeg', '-hide_banner', '-encoders'], check=True, capture_output=True, text=True)
+    except (OSError, subprocess.CalledProcessError):
+        return 'libx264'
+
+    for encoder in ('h264_nvenc', 'h264_qsv'):
+        if encoder not in result.stdout:
+            continue
+        # 编码器编译进ffmpeg不代表机器上有对应的硬件，也不代表支持实际使用的参数（如旧版NVENC不认识p4预设），
+        # 用运行时的完整编码参数分别试编码一帧确认可用
+        usable = True
+        for still_image in (False, True):
+            test_command = [
+                'ffmpeg', '-hide_banner', '-f', 'lavfi', '-i', 'color=size=256x256',
+                '-frames:v', '1', *video_codec_args(still_image, encoder),
+                '-pix_fmt', 'yuv420p', '-f', 'null', '-'
+            ]
+            if subprocess.run(test_command, capture_output=True).returncode != 0:
+                usable = False
+                break
+        if usable:
+            return encoder
+    return 'libx264'
+
+# 启动时检测一次视频编码器
+VIDEO_ENCODER = detect_video_encoder()
+print(f"使用视频编码器: {VIDEO_ENCODER}")
+
+# ffmpeg/ffprobe读取远程URL的超时时间（微秒），默认无限等待，源站卡住时任务会一直挂起
+RW_TIMEOUT_US = str(30 * 1000 * 1000)
+
+# 拼接结果超过该时长（秒）时输出分片MP4：边写边可播放，省去faststart在结束时重写整个文件
+FRAGMENTED_MP4_MIN_DURATION = 600
+
+# 后台任务状态（内存存储），键为任务ID；已结束的任务保留一天供查询
+JOBS: Dict[str, Dict[str, Any]] = {}
+JOB_RETENTION_SECONDS = 24 * 60 * 60
+
 # 挂载静态文件目录
 app.mount("/static", StaticFiles(directory=STATIC_DIR), name="static")
 
+# 日期目录缓存：(日期, (年月, 日))，只在日期变化时重新计算
+_date_directory_cache = (None, None)
+# 本进程已创建过的日期目录，避免每次请求都调用makedirs
+_dirs_created = set()
+
 def get_date_directory():
-    """获取当前日期的目录路径"""
-    today = datetime.datetime.now()
-    year_month = today.strftime("%Y-%m")
-    day = today.strftime("%d")
-    return year_month, day
-
-def upload_local_file(file_path):
-    """上传文件到本地目录并返回可访问的URL"""
+    """获取当前日期的目录路径，同一天内复用已计算的结果"""
+    global _date_directory_cache
+    today = datetime.date.today()
+    cache_date, paths = _date_directory_cache
+    if cache_date != today:
+        paths = (today.strftime("%Y-%m"), today.strftime("%d"))
+        _date_directory_cache = (today, paths)
+    return paths
+
+def new_file_id() -> str:
+    """生成唯一文件名：纳秒时间戳加随机后缀，按时间排序且难以猜测"""
+    return f"{time.time_ns():016x}{os.urandom(4).hex()}"
+
+def reserve_output_path(ext: str = ".mp4") -> Tuple[str, str]:
+    """在本地静态目录中预留输出文件路径，返回绝对文件路径和可访问的URL"""
     # 获取日期目录
     year_month, day = get_date_directory()
     date_dir = os.path.join(STATIC_DIR, "videos", year_month, day)
 
-    # 确保目录存在
-    os.makedirs(date_dir, exist_ok=True)
+    # 确保目录存在，每个目录只需创建一次
+    if date_dir not in _dirs_created:
+        os.makedirs(date_dir, exist_ok=True)
+        _dirs_created.add(date_dir)
 
-    output_filename = os.path.basename(file_path)
-    destination = os.path.join(date_dir, output_filename)
-
-    # 复制文件
-    shutil.copy(file_path, destination)
-    print(f"文件已保存到本地目录: {destination}")
+    output_filename = f"{new_file_id()}{ext}"
+    abs_path = os.path.abspath(os.path.join(date_dir, output_filename))
+    print(f"输出文件的绝对路径: {abs_path}")
 
     # 返回可访问的URL（相对URL）
     relative_url = f"/static/videos/{year_month}/{day}/{output_filename}"
@@ -57,61 +152,170 @@ def upload_local_file(file_path):
     url = f"http://video-api.fyshark.com{relative_url}"
     print(f"生成的文件URL: {url}")
 
-    # 返回绝对文件路径
-    abs_path = os.path.abspath(destination)
-    print(f"文件的绝对路径: {abs_path}")
-
-    return url
+    return abs_path, url
+
+def guess_image_extension(url: str, content_type: Optional[str] = None) -> str:
+    """根据Content-Type或URL路径推断图片扩展名，ffmpeg依据扩展名选择图片解码器"""
+    # 优先使用服务器声明的图片类型，URL扩展名可能与实际内容不符（如图片处理参数转换了格式）
+    if content_type:
+        mime_type = content_type.split(';')[0].strip().lower()
+        if mime_type.startswith('image/'):
+            ext = mimetypes.guess_extension(mime_type)
+            if ext:
+                return ext
+
+    # 只接受确实对应图片类型的URL扩展名，排除 .php、.do 等动态页面
+    ext = os.path.splitext(urlparse(url).path)[1].lower()
+    mime_type, _ = mimetypes.guess_type(f"file{ext}")
+    if ext and mime_type and mime_type.startswith('image/'):
+        return ext
+    return '.jpg'
+
+def parse_cache_control(headers) -> Dict[str, Any]:
+    """解析响应头Cache-Control，返回no_store、no_cache以及按max-age计算的过期时间expires_at"""
+    policy = {"no_store": False, "no_cache": False, "expires_at": None}
+    for directive in (headers.get('Cache-Control') or '').split(','):
+        name, _, value = directive.strip().partition('=')
+        name = name.lower()
+        if name == 'no-store':
+            policy["no_store"] = True
+        elif name == 'no-cache':
+            policy["no_cache"] = True
+        elif name == 'max-age' and value.strip().isdigit():
+            policy["expires_at"] = time.time() + int(value.strip())
+    return policy
+
+def save_response_body(response, path: str):
+    """把响应内容流式写入文件；先写入临时文件再重命名，避免其他请求读到写了一半的文件"""
+    partial_path = f"{path}.{new_file_id()}.part"
+    try:
+        response.raw.decode_content = True  # 解开gzip等传输压缩
+        with open(partial_path, 'wb') as f:
+            shutil.copyfileobj(response.raw, f, length=1024*1024)
+        os.replace(partial_path, path)
+    finally:
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+
+def write_cache_meta(meta_path: str, meta: Dict[str, Any]):
+    """先写入临时文件再重命名，避免并发请求读到写了一半的缓存信息"""
+    partial_meta_path = f"{meta_path}.{new_file_id()}.part"
+    with open(partial_meta_path, 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+    os.replace(partial_meta_path, meta_path)
+
+def link_cached_file(cached_path: str) -> str:
+    """为本次任务创建缓存文件的硬链接，缓存之后被新内容替换时任务仍读取原来的文件"""
+    job_path = os.path.join(CACHE_JOB_DIR, f"{new_file_id()}{os.path.splitext(cached_path)[1]}")
+    try:
+        os.link(cached_path, job_path)
+    except OSError:
+        # 文件系统不支持硬链接时回退到复制
+        shutil.copyfile(cached_path, job_path)
+    return job_path
+
+def fetch_cached(url: str) -> str:
+    """下载远程文件到本地缓存目录，同一URL再次请求时复用缓存
+
+    返回本次任务专用的缓存文件硬链接，使用完毕后由调用方删除。
+    """
+    key = hashlib.blake2b(url.encode('utf-8')).hexdigest()
+    meta_path = os.path.join(CACHE_DIR, f"{key}.json")
+
+    meta = None
+    cached_path = None
+    headers = {}
+    if os.path.exists(meta_path):
+        with open(meta_path, encoding='utf-8') as f:
+            meta = json.load(f)
+        if os.path.exists(os.path.join(CACHE_DIR, meta["filename"])):
+            cached_path = os.path.join(CACHE_DIR, meta["filename"])
+
+    if cached_path:
+        expires_at = meta.get("expires_at")
+        has_validators = bool(meta.get("etag") or meta.get("last_modified"))
+        if meta.get("no_cache"):
+            # no-cache：每次使用前都必须向源站确认
+            fresh = False
+        elif expires_at is not None:
+            fresh = time.time() < expires_at
+        else:
+            # 源站没有给出缓存时效：能校验时发起条件请求，无法校验时直接复用
+            fresh = not has_validators
 
-def upload_to_oss(file_path: str) -> str:
-    """使用本地存储替代OSS上传"""
-    print(f"使用本地存储: {file_path}")
-    return upload_local_file(file_path)
+        if fresh:
+            print(f"使用缓存文件: {cached_path}")
+            return link_cached_file(cached_path)
 
-def convert_audio_format(input_path, volume_db: float = 0):
-    """将音频转换为WAV格式并调整音量，并保存到静态文件目录"""
-    temp_dir = tempfile.gettempdir()
-    temp_output_filename = f"{uuid.uuid4()}.wav"
-    temp_output_path = os.path.join(temp_dir, temp_output_filename)
+        # 带上ETag/Last-Modified发起条件请求，内容未变化时服务器返回304；
+        # 没有校验信息的过期缓存不带条件，重新完整下载
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
 
+    print(f"下载文件: {url}")
     try:
-        # 使用ffmpeg转换音频格式并调整音量
-        command = [
-            'ffmpeg', '-i', input_path,
-            '-acodec', 'pcm_s16le',  # 使用PCM编码
-            '-ar', '44100',          # 设置采样率
-            '-ac', '2',              # 设置声道数
-            '-af', f'volume={10**(volume_db/20)}',  # 调整音量
-            '-y',                    # 覆盖已存在的文件
-            temp_output_path
-        ]
-        subprocess.run(command, check=True, capture_output=True)
-
-        # 获取年月日目录
-        year_month, day = get_date_directory()
-        static_audio_dir = os.path.join(STATIC_DIR, "videos", year_month, day)
-        os.makedirs(static_audio_dir, exist_ok=True)
+        response = HTTP_SESSION.get(url, headers=headers, stream=True, timeout=30)
+    except requests.RequestException as e:
+        if cached_path:
+            print(f"源站不可用，使用缓存文件: {cached_path} ({str(e)})")
+            return link_cached_file(cached_path)
+        raise
+
+    with response:
+        if response.status_code == 304 and cached_path:
+            policy = parse_cache_control(response.headers)
+            meta.update(no_cache=policy["no_cache"], expires_at=policy["expires_at"])
+            write_cache_meta(meta_path, meta)
+            print(f"缓存未变化，使用缓存文件: {cached_path}")
+            return link_cached_file(cached_path)
+        if response.status_code >= 500 and cached_path:
+            print(f"源站返回错误（状态码: {response.status_code}），使用缓存文件: {cached_path}")
+            return link_cached_file(cached_path)
+        if response.status_code != 200:
+            raise Exception(f"无法下载文件，状态码: {response.status_code}")
+
+        # 直接保存原始数据，保留原始扩展名供ffmpeg识别格式
+        content_type = response.headers.get('Content-Type')
+        ext = guess_image_extension(url, content_type)
+        policy = parse_cache_control(response.headers)
+
+        # 不允许缓存（no-store）或者不是图片类型（例如以200返回的错误页面）时，
+        # 只下载给本次任务使用，不写入缓存
+        mime_type = (content_type or '').split(';')[0].strip().lower()
+        if policy["no_store"] or not mime_type.startswith('image/'):
+            if policy["no_store"] and meta:
+                # 源站已禁止缓存，删除之前的缓存记录
+                for stale_path in (meta_path, os.path.join(CACHE_DIR, meta["filename"])):
+                    if os.path.exists(stale_path):
+                        os.remove(stale_path)
+            job_path = os.path.join(CACHE_JOB_DIR, f"{new_file_id()}{ext}")
+            save_response_body(response, job_path)
+            print(f"文件不写入缓存（Content-Type: {content_type}, Cache-Control: {response.headers.get('Cache-Control')}）: {job_path}")
+            return job_path
+
+        filename = f"{key}{ext}"
+        new_cached_path = os.path.join(CACHE_DIR, filename)
+        save_response_body(response, new_cached_path)
+
+        new_meta = {
+            "url": url,
+            "filename": filename,
+            "etag": response.headers.get('ETag'),
+            "last_modified": response.headers.get('Last-Modified'),
+            "no_cache": policy["no_cache"],
+            "expires_at": policy["expires_at"]
+        }
 
-        # 复制文件到静态目录
-        final_filename = f"{uuid.uuid4()}.wav"
-        final_path = os.path.join(static_audio_dir, final_filename)
-        shutil.copy(temp_output_path, final_path)
+    write_cache_meta(meta_path, new_meta)
 
-        # 清理临时文件
-        os.remove(temp_output_path)
+    # 扩展名变化时旧的缓存文件不会再被引用，删除它；正在使用的任务持有各自的硬链接，不受影响
+    if cached_path and cached_path != new_cached_path and os.path.exists(cached_path):
+        os.remove(cached_path)
 
-        print(f"音频文件已保存到: {final_path}")
-        return final_path
-    except subprocess.CalledProcessError as e:
-        # 清理临时文件
-        if os.path.exists(temp_output_path):
-            os.remove(temp_output_path)
-        raise Exception(f"音频转换失败: {str(e)}")
-    except Exception as e:
-        # 清理临时文件
-        if os.path.exists(temp_output_path):
-            os.remove(temp_output_path)
-        raise Exception(f"音频处理失败: {str(e)}")
+    print(f"文件已缓存到: {new_cached_path}")
+    return link_cached_file(new_cached_path)
 
 class ImageToVideoRequest(BaseModel):
     image_url: str
@@ -136,273 +340,347 @@ class ConcatenateVideosRequest(BaseModel):
         le=20
     )
 
-class VideoResponse(BaseModel):
-    video_url: str
-    duration: float
+class JobResponse(BaseModel):
+    job_id: str
 
-def get_video_info(file_path: str) -> Dict[str, Any]:
-    """获取视频信息，包括时长等"""
-    try:
-        video = VideoFileClip(file_path)
-        info = {
-            "duration": round(video.duration, 2),  # 视频时长（秒）
-            "size": os.path.getsize(file_path),    # 文件大小（字节）
-            "fps": video.fps if hasattr(video, 'fps') else None,  # 帧率
-            "width": video.w if hasattr(video, 'w') else None,    # 宽度
-            "height": video.h if hasattr(video, 'h') else None    # 高度
-        }
-        video.close()  # 关闭视频文件
-        return info
-    except Exception as e:
-        print(f"获取视频信息失败: {str(e)}")
-        return {"duration": 0, "error": str(e)}
-
-@app.post("/image-to-video", response_model=VideoResponse)
-async def image_to_video(request: ImageToVideoRequest):
-    # 生成唯一输出文件名
-    output_filename = f"{uuid.uuid4()}.mp4"
-    output_path = os.path.join(OUTPUT_DIR, output_filename)
+class JobStatusResponse(BaseModel):
+    job_id: str
+    status: str  # pending | running | done | error
+    video_url: Optional[str] = None
+    duration: Optional[float] = None
+    error: Optional[str] = None
 
-    temp_image_path = None
+def run_media_command(command: List[str]) -> subprocess.CompletedProcess:
+    """执行ffmpeg/ffprobe命令；失败时返回stderr末尾的错误原因，不把完整命令和本地路径暴露给客户端"""
     try:
-        # 处理URL图像：如果是远程URL，先下载到本地临时文件
-        if request.image_url.startswith(('http://', 'https://')):
-            try:
-                print(f"下载图像: {request.image_url}")
-
-                # 使用requests下载图片
-                response = requests.get(request.image_url, timeout=30)
-                if response.status_code == 200:
-                    img = Image.open(io.BytesIO(response.content))
-                    temp_image_path = os.path.join(tempfile.gettempdir(), f"{uuid.uuid4()}.jpg")
-                    img.save(temp_image_path)
-                    print(f"图像已下载到: {temp_image_path}")
-                    image_path = temp_image_path
-                else:
-                    raise HTTPException(status_code=400, detail=f"无法下载图像，状态码: {response.status_code}")
-            except Exception as e:
-                if temp_image_path and os.path.exists(temp_image_path):
-                    os.remove(temp_image_path)
-                raise HTTPException(status_code=400, detail=f"处理图像URL时出错: {str(e)}")
-        else:
-            # 本地文件路径
-            image_path = request.image_url
-
-        # 创建视频
-        clip = ImageClip(image_path).set_duration(request.duration)
-        clip.write_videofile(output_path, fps=24, codec='libx264', audio_codec='aac')
-
-        # 清理临时图像文件
-        if temp_image_path and os.path.exists(temp_image_path):
-            os.remove(temp_image_path)
-
-        # 获取视频信息
-        video_info = get_video_info(output_path)
-
-        # 上传到本地存储
-        video_url = upload_to_oss(output_path)
-
-        # 清理本地文件
-        os.remove(output_path)
-
-        return {"video_url": video_url, "duration": video_info["duration"]}
-    except Exception as e:
-        # 确保清理所有临时文件
-        if temp_image_path and os.path.exists(temp_image_path):
-            os.remove(temp_image_path)
-        if os.path.exists(output_path):
-            os.remove(output_path)
-
-        raise HTTPException(status_code=500, detail=f"创建视频失败: {str(e)}")
-
-@app.post("/image-audio-to-video", response_model=VideoResponse)
-async def image_audio_to_video(request: ImageAudioToVideoRequest):
-    # 生成唯一输出文件名
-    output_filename = f"{uuid.uuid4()}.mp4"
-    output_path = os.path.join(OUTPUT_DIR, output_filename)
-
-    temp_image_path = None
-    temp_audio_path = None
-
+        return subprocess.run(command, check=True, capture_output=True)
+    except subprocess.CalledProcessError as e:
+        stderr_lines = [line for line in (e.stderr or b'').decode('utf-8', errors='replace').splitlines() if line.strip()]
+        stderr_tail = '\n'.join(stderr_lines[-5:])[-1000:]
+        # 完整命令只写入服务端日志，便于排查
+        print(f"{command[0]}执行失败（退出码 {e.returncode}）: {' '.join(command)}\n{stderr_tail}")
+        raise Exception(f"{command[0]}执行失败（退出码 {e.returncode}）: {stderr_tail}") from None
+
+def probe_streams(file_path: str) -> List[Dict[str, Any]]:
+    """使用ffprobe获取媒体文件的流信息"""
+    # -show_data_hash 输出extradata（如H.264的SPS/PPS）的哈希，用于判断能否直接拼接
+    command = [
+        'ffprobe', '-v', 'error', '-rw_timeout', RW_TIMEOUT_US,
+        '-show_streams', '-show_data_hash', 'sha256', '-of', 'json', file_path
+    ]
+    result = run_media_command(command)
+    return json.loads(result.stdout).get("streams", [])
+
+async def run_ffmpeg(command: List[str], encode: bool = True):
+    """在线程池中执行ffmpeg命令，避免阻塞事件循环
+
+    encode为True时占用一个编码名额，限制同时进行的编码数量；
+    只复制流、主要耗时在读写的命令不占用编码名额。
+    """
+    if not encode:
+        await asyncio.to_thread(run_media_command, command)
+        return
+
+    # -threads 作为输出选项放在输出文件之前
+    command = command[:-1] + ['-threads', str(THREADS_PER_ENCODE), command[-1]]
+    async with encode_semaphore:
+        await asyncio.to_thread(run_media_command, command)
+
+def stream_signature(streams: List[Dict[str, Any]]) -> List[tuple]:
+    """提取决定能否直接拼接的流参数（编码、编码配置、分辨率、像素格式、时间基、采样率等）"""
+    # concat分离器只保留第一个文件的编码头信息，extradata/profile/level不同的流无法直接拼接
+    keys = (
+        "codec_type", "codec_name", "profile", "level", "extradata_hash",
+        "width", "height", "pix_fmt", "time_base", "sample_rate", "channels"
+    )
+    return [tuple(stream.get(key) for key in keys) for stream in streams]
+
+def streams_duration(streams: List[Dict[str, Any]]) -> float:
+    """根据ffprobe的流信息估算媒体时长（取最长的流）"""
+    return max((float(stream.get("duration") or 0) for stream in streams), default=0)
+
+def write_concat_list(video_paths: List[str]) -> str:
+    """生成ffmpeg concat分离器使用的文件列表（本地路径或远程URL），返回列表文件路径"""
+    list_path = os.path.join(tempfile.gettempdir(), f"{new_file_id()}.txt")
+    with open(list_path, 'w', encoding='utf-8') as f:
+        for path in video_paths:
+            if not path.startswith(('http://', 'https://')):
+                path = os.path.abspath(path)
+            # concat列表中单引号需要转义
+            escaped_path = path.replace("'", "'\\''")
+            f.write(f"file '{escaped_path}'\n")
+            # 为每个文件设置读取超时，避免远程源站卡住时任务一直挂起
+            f.write(f"option rw_timeout {RW_TIMEOUT_US}\n")
+    return list_path
+
+def concatenate_with_moviepy(video_paths: List[str], volume_db: Optional[float], output_path: str):
+    """用MoviePy解码拼接并重新编码；导入、打开文件和编码都是阻塞操作，需在线程中执行"""
+    # MoviePy导入开销较大，只在需要回退时才导入
+    from moviepy.editor import VideoFileClip, concatenate_videoclips
+
+    source_clips = []
+    final_clip = None
     try:
-        # 处理URL图像：如果是远程URL，先下载到本地临时文件
-        if request.image_url.startswith(('http://', 'https://')):
-            try:
-                print(f"下载图像: {request.image_url}")
-                # 使用requests下载图片
-                response = requests.get(request.image_url, timeout=30)
-                if response.status_code == 200:
-                    img = Image.open(io.BytesIO(response.content))
-                    temp_image_path = os.path.join(tempfile.gettempdir(), f"{uuid.uuid4()}.jpg")
-                    img.save(temp_image_path)
-                    print(f"图像已下载到: {temp_image_path}")
-                    image_path = temp_image_path
-                else:
-                    raise HTTPException(status_code=400, detail=f"无法下载图像，状态码: {response.status_code}")
-            except Exception as e:
-                raise HTTPException(status_code=400, detail=f"处理图像URL时出错: {str(e)}")
-        else:
-            # 本地文件路径
-            image_path = request.image_url
-
-        # 处理URL音频：如果是远程URL，先下载到本地临时文件
-        if request.audio_url.startswith(('http://', 'https://')):
-            try:
-                print(f"下载音频: {request.audio_url}")
-                temp_audio_path = os.path.join(tempfile.gettempdir(), f"{uuid.uuid4()}.mp3")
-                # 使用requests下载音频
-                response = requests.get(request.audio_url, timeout=30)
-                if response.status_code == 200:
-                    with open(temp_audio_path, 'wb') as f:
-                        f.write(response.content)
-                    print(f"音频已下载到: {temp_audio_path}")
-                    audio_path = temp_audio_path
-                else:
-                    raise HTTPException(status_code=400, detail=f"无法下载音频，状态码: {response.status_code}")
-            except Exception as e:
-                # 清理临时文件
-                if temp_image_path and os.path.exists(temp_image_path):
-                    os.remove(temp_image_path)
-                raise HTTPException(status_code=400, detail=f"处理音频URL时出错: {str(e)}")
-        else:
-            # 本地文件路径
-            audio_path = request.audio_url
-
-        # 转换音频格式并调整音量
-        converted_audio_path = convert_audio_format(audio_path, request.volume_db)
-
-        # 加载音频
-        audio = AudioFileClip(converted_audio_path)
-
-        # 创建视频
-        clip = ImageClip(image_path).set_duration(audio.duration)
-        clip = clip.set_audio(audio)
+        clips = []
+        for video_path in video_paths:
+            clip = VideoFileClip(video_path)
+            source_clips.append(clip)
+            if volume_db:
+                # 调整音频音量
+                clip = clip.volumex(10**(volume_db/20))
+            clips.append(clip)
 
-        # 使用更明确的编码器设置
-        clip.write_videofile(
+        final_clip = concatenate_videoclips(clips)
+        preset, encoder_params = video_encoder_options()
+        final_clip.write_videofile(
             output_path,
-            fps=24,
-            codec='libx264',
+            codec=VIDEO_ENCODER,
             audio_codec='aac',
-            audio_bitrate='192k'
+            audio_bitrate='192k',
+            preset=preset,
+            ffmpeg_params=encoder_params + ['-movflags', '+faststart'],
+            threads=THREADS_PER_ENCODE
         )
+    finally:
+        # 关闭所有视频，释放ffmpeg读取进程
+        if final_clip is not None:
+            final_clip.close()
+        for clip in source_clips:
+            clip.close()
 
-        # 清理所有临时文件
-        if temp_image_path and os.path.exists(temp_image_path):
-            os.remove(temp_image_path)
-        if temp_audio_path and os.path.exists(temp_audio_path):
-            os.remove(temp_audio_path)
-
-        # 获取视频信息
-        video_info = get_video_info(output_path)
+def get_video_info(file_path: str) -> Dict[str, Any]:
+    """使用ffprobe获取视频信息，包括时长等"""
+    try:
+        command = [
+            'ffprobe', '-v', 'error',
+            '-select_streams', 'v:0',
+            '-show_entries', 'format=duration,size:stream=width,height,r_frame_rate',
+            '-of', 'json', file_path
+        ]
+        result = run_media_command(command)
+        probe = json.loads(result.stdout)
+        video_format = probe.get("format", {})
+        stream = (probe.get("streams") or [{}])[0]
+
+        # 帧率格式为 "分子/分母"，例如 "24/1"
+        fps = None
+        if stream.get("r_frame_rate"):
+            num, den = stream["r_frame_rate"].split('/')
+            fps = float(num) / float(den) if float(den) else None
+
+        return {
+            "duration": round(float(video_format.get("duration", 0)), 2),  # 视频时长（秒）
+            "size": int(video_format.get("size", 0)),  # 文件大小（字节）
+            "fps": fps,                                # 帧率
+            "width": stream.get("width"),              # 宽度
+            "height": stream.get("height")             # 高度
+        }
+    except Exception as e:
+        print(f"获取视频信息失败: {str(e)}")
+        return {"duration": 0, "error": str(e)}
 
-        # 上传到本地存储
-        video_url = upload_to_oss(output_path)
+async def create_image_video(request: ImageToVideoRequest, output_path: str):
+    """将图片编码为指定时长的视频"""
+    # 处理URL图像：如果是远程URL，先下载到本地缓存（同一URL重复请求时复用）
+    cached_image_path = None
+    if request.image_url.startswith(('http://', 'https://')):
+        try:
+            # 下载和写缓存文件都是阻塞IO，放到线程中执行，不阻塞事件循环
+            image_path = cached_image_path = await asyncio.to_thread(fetch_cached, request.image_url)
+        except Exception as e:
+            raise Exception(f"处理图像URL时出错: {str(e)}")
+    else:
+        # 本地文件路径
+        image_path = request.image_url
 
-        # 清理本地文件
-        os.remove(output_path)
-        # 清理转换后的音频文件（如果存在且是临时文件）
-        if os.path.exists(converted_audio_path) and converted_audio_path.startswith(tempfile.gettempdir()):
-            os.remove(converted_audio_path)
+    try:
+        # 使用ffmpeg直接将静态图片编码为视频，静态画面使用专门的编码参数
+        command = [
+            # 强制使用image2分离器：gif等格式按扩展名会选中不支持-loop的分离器；
+            # pattern_type none避免文件名中的%被当成图片序列模板
+            'ffmpeg', '-f', 'image2', '-pattern_type', 'none',
+            '-loop', '1', '-framerate', '24', '-i', image_path,
+            '-t', str(request.duration),
+            *video_codec_args(still_image=True),
+            '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2',  # yuv420p要求宽高为偶数
+            '-pix_fmt', 'yuv420p',
+            '-movflags', '+faststart',
+            '-y', output_path
+        ]
+        await run_ffmpeg(command)
+    finally:
+        # 删除本次任务使用的缓存文件硬链接
+        if cached_image_path and os.path.exists(cached_image_path):
+            os.remove(cached_image_path)
+
+async def create_image_audio_video(request: ImageAudioToVideoRequest, output_path: str):
+    """将图片和音频合成为视频，视频时长以音频为准"""
+    # 处理URL图像：如果是远程URL，先下载到本地缓存（同一URL重复请求时复用）
+    cached_image_path = None
+    if request.image_url.startswith(('http://', 'https://')):
+        try:
+            # 下载和写缓存文件都是阻塞IO，放到线程中执行，不阻塞事件循环
+            image_path = cached_image_path = await asyncio.to_thread(fetch_cached, request.image_url)
+        except Exception as e:
+            raise Exception(f"处理图像URL时出错: {str(e)}")
+    else:
+        # 本地文件路径
+        image_path = request.image_url
 
-        return {"video_url": video_url, "duration": video_info["duration"]}
-    except Exception as e:
-        # 清理所有临时文件
-        if temp_image_path and os.path.exists(temp_image_path):
-            os.remove(temp_image_path)
-        if temp_audio_path and os.path.exists(temp_audio_path):
-            os.remove(temp_audio_path)
-        if os.path.exists(output_path):
-            os.remove(output_path)
+    try:
+        # 音频URL（本地路径或http(s)地址）直接交给ffmpeg读取，无需先下载
+        audio_path = request.audio_url
 
-        raise HTTPException(status_code=500, detail=f"创建视频失败: {str(e)}")
+        # 使用ffmpeg一次完成图片循环编码、音量调整和音频合成，不再生成中间WAV文件；
+        # -shortest 让输出在音频结束时停止，无需事先探测音频时长（避免再次下载远程音频）
+        command = [
+            # 强制使用image2分离器：gif等格式按扩展名会选中不支持-loop的分离器；
+            # pattern_type none避免文件名中的%被当成图片序列模板
+            'ffmpeg', '-f', 'image2', '-pattern_type', 'none',
+            '-loop', '1', '-framerate', '24', '-i', image_path,
+            '-rw_timeout', RW_TIMEOUT_US, '-i', audio_path,
+            '-af', f'volume={10**(request.volume_db/20)}',
+            *video_codec_args(still_image=True),
+            '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2',  # yuv420p要求宽高为偶数
+            '-pix_fmt', 'yuv420p',
+            '-c:a', 'aac',
+            '-b:a', '192k',
+            '-shortest',
+            '-movflags', '+faststart',
+            '-y', output_path
+        ]
+        await run_ffmpeg(command)
+    finally:
+        # 删除本次任务使用的缓存文件硬链接
+        if cached_image_path and os.path.exists(cached_image_path):
+            os.remove(cached_image_path)
 
-@app.post("/concatenate-videos", response_model=VideoResponse)
-async def concatenate_videos(request: ConcatenateVideosRequest):
-    # 生成唯一输出文件名
-    output_filename = f"{uuid.uuid4()}.mp4"
-    output_path = os.path.join(OUTPUT_DIR, output_filename)
+async def concatenate_video_files(request: ConcatenateVideosRequest, output_path: str):
+    """按顺序拼接多个视频"""
+    # 视频URL（本地路径或http(s)地址）直接交给ffprobe和ffmpeg读取，无需先下载
+    video_paths = list(request.video_urls)
 
     # 临时文件列表，用于清理
     temp_files = []
 
     try:
-        # 加载所有视频，如果是远程URL则先下载到本地
-        clips = []
-        for url in request.video_urls:
-            local_video_path = None
-
-            # 检查是否为远程URL
-            if url.startswith(('http://', 'https://')):
-                try:
-                    # 创建临时文件下载路径
-                    local_video_path = os.path.join(tempfile.gettempdir(), f"{uuid.uuid4()}.mp4")
-
-                    # 下载视频文件
-                    print(f"下载视频: {url}")
-                    response = requests.get(url, stream=True, timeout=30)
-                    if response.status_code == 200:
-                        with open(local_video_path, 'wb') as f:
-                            for chunk in response.iter_content(chunk_size=1024*1024):
-                                if chunk:  # 过滤掉保持连接的空数据块
-                                    f.write(chunk)
-                        print(f"视频已下载到: {local_video_path}")
-                        temp_files.append(local_video_path)
-                        video_path = local_video_path
-                    else:
-                        raise HTTPException(status_code=400, detail=f"无法下载视频，状态码: {response.status_code}")
-                except Exception as e:
-                    raise HTTPException(status_code=400, detail=f"处理视频URL时出错: {str(e)}")
-            else:
-                # 本地文件路径
-                video_path = url
-
-            # 加载视频
-            clip = VideoFileClip(video_path)
-            if request.volume_db != 0:
-                # 调整音频音量
-                clip = clip.volumex(10**(request.volume_db/20))
-            clips.append(clip)
-
-        if not clips:
-            raise HTTPException(status_code=400, detail="没有有效的视频文件可合并")
-
-        # 拼接视频
-        final_clip = concatenate_videoclips(clips)
-        final_clip.write_videofile(
-            output_path,
-            codec='libx264',
-            audio_codec='aac',
-            audio_bitrate='192k'
+        # 比较所有视频的流参数，一致时可以直接拼接而无需重新编码
+        # 远程URL的探测互不依赖，并发执行，总耗时取决于最慢的一个而不是全部之和
+        all_streams = await asyncio.gather(
+            *(asyncio.to_thread(probe_streams, path) for path in video_paths)
         )
-
-        # 获取视频信息
-        video_info = get_video_info(output_path)
-
-        # 上传到本地存储
-        video_url = upload_to_oss(output_path)
-
+        signatures = [stream_signature(streams) for streams in all_streams]
+
+        if all(signature == signatures[0] for signature in signatures):
+            list_path = await asyncio.to_thread(write_concat_list, video_paths)
+            temp_files.append(list_path)
+
+            command = [
+                'ffmpeg', '-f', 'concat', '-safe', '0',
+                '-protocol_whitelist', 'file,http,https,tcp,tls',  # 允许列表中包含远程URL
+                '-i', list_path
+            ]
+            if request.volume_db:
+                # 只重新编码音频以调整音量，视频流直接复制
+                command += [
+                    '-c:v', 'copy',
+                    '-c:a', 'aac',
+                    '-b:a', '192k',
+                    '-af', f'volume={10**(request.volume_db/20)}'
+                ]
+            else:
+                # 音视频流都直接复制
+                command += ['-c', 'copy']
+            # 把索引放在文件开头，播放器无需下载完整文件即可开始播放
+            total_duration = sum(streams_duration(streams) for streams in all_streams)
+            if total_duration >= FRAGMENTED_MP4_MIN_DURATION:
+                command += ['-movflags', '+frag_keyframe+empty_moov+default_base_moof']
+            else:
+                command += ['-movflags', '+faststart']
+            command += ['-y', output_path]
+            # 视频流直接复制，最多只重新编码音频，耗时主要在读写上，不占用编码名额
+            await run_ffmpeg(command, encode=False)
+        else:
+            # 编码参数不一致，回退到解码后重新编码
+            async with encode_semaphore:
+                await asyncio.to_thread(
+                    concatenate_with_moviepy, video_paths, request.volume_db, output_path
+                )
+    finally:
         # 清理所有临时文件
         for temp_file in temp_files:
             if os.path.exists(temp_file):
                 os.remove(temp_file)
 
-        # 清理输出文件
-        if os.path.exists(output_path):
-            os.remove(output_path)
+def prune_jobs():
+    """清理超过保留时间的已结束任务，避免任务记录无限增长"""
+    expire_before = time.time() - JOB_RETENTION_SECONDS
+    expired = [
+        job_id for job_id, job in JOBS.items()
+        if job.get("finished_at") and job["finished_at"] < expire_before
+    ]
+    for job_id in expired:
+        del JOBS[job_id]
+
+async def run_job(job_id: str, task, request: BaseModel, output_path: str, error_prefix: str):
+    """在后台执行视频处理任务，并把结果写入任务状态"""
+    job = JOBS[job_id]
+    job["status"] = "running"
+    try:
+        await task(request, output_path)
 
-        return {"video_url": video_url, "duration": video_info["duration"]}
+        # 获取视频信息
+        video_info = await asyncio.to_thread(get_video_info, output_path)
+        job.update(status="done", duration=video_info["duration"])
     except Exception as e:
-        # 清理所有临时文件
-        for temp_file in temp_files:
-            if os.path.exists(temp_file):
-                os.remove(temp_file)
-
-        # 清理输出文件
+        # 清理未完成的输出文件
         if os.path.exists(output_path):
             os.remove(output_path)
-
-        raise HTTPException(status_code=500, detail=f"合并视频失败: {str(e)}")
+        print(f"任务 {job_id} 失败: {str(e)}")
+        job.update(status="error", error=f"{error_prefix}: {str(e)}")
+    finally:
+        job["finished_at"] = time.time()
+
+def submit_job(background_tasks: BackgroundTasks, task, request: BaseModel, error_prefix: str) -> Dict[str, str]:
+    """预留输出文件并创建任务，实际处理在响应返回后于后台执行"""
+    prune_jobs()
+
+    # 预留输出文件路径，ffmpeg直接写入静态目录
+    output_path, video_url = reserve_output_path(".mp4")
+
+    job_id = new_file_id()
+    JOBS[job_id] = {"status": "pending", "video_url": video_url}
+    background_tasks.add_task(run_job, job_id, task, request, output_path, error_prefix)
+    return {"job_id": job_id}
+
+@app.post("/image-to-video", response_model=JobResponse)
+async def image_to_video(request: ImageToVideoRequest, background_tasks: BackgroundTasks):
+    return submit_job(background_tasks, create_image_video, request, "创建视频失败")
+
+@app.post("/image-audio-to-video", response_model=JobResponse)
+async def image_audio_to_video(request: ImageAudioToVideoRequest, background_tasks: BackgroundTasks):
+    return submit_job(background_tasks, create_image_audio_video, request, "创建视频失败")
+
+@app.post("/concatenate-videos", response_model=JobResponse)
+async def concatenate_videos(request: ConcatenateVideosRequest, background_tasks: BackgroundTasks):
+    if not request.video_urls:
+        raise HTTPException(status_code=400, detail="没有有效的视频文件可合并")
+    return submit_job(background_tasks, concatenate_video_files, request, "合并视频失败")
+
+@app.get("/jobs/{job_id}", response_model=JobStatusResponse)
+async def get_job(job_id: str):
+    job = JOBS.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="任务不存在")
+
+    return {
+        "job_id": job_id,
+        "status": job["status"],
+        # 任务完成后才返回视频地址
+        "video_url": job["video_url"] if job["status"] == "done" else None,
+        "duration": job.get("duration"),
+        "error": job.get("error")
+    }
 
 if __name__ == "__main__":
     import uvicorn